@@ -15,161 +15,355 @@
 # builds a filename from this metadata and downloads the episode if the filename is not already present
 # in a particular location. As an addon, it copies ID3 v2 metadata from the RSS entry to the mp3 file
 #
-# Caveat: at the moment, the code uses the OS's native curl binary to download the mp3 files after extracting 
-# the URLs from the feed entries as pycurl was way too slow. If somebody knows a hack to speed up
-# pycurl, I am looking forward to a corresponding PR.
+# The mp3 files are downloaded with a single httpx client (https://www.python-httpx.org) shared by all
+# downloads. This replaces the OS's native curl binary used before: spawning curl for every episode meant a
+# new process plus a fresh TCP and TLS handshake each time, whereas the client keeps connections to the
+# podcast hosts alive and reuses them.
 #
 # The code relies heavily on the mutagen and feedparser packages in order to manipulate the ID3 tags and to 
 # download and analyse the RSS feeds (https://mutagen.readthedocs.io/en/latest and https://pythonhosted.org/feedparser).
+# If fastfeedparser (https://github.com/kagisearch/fastfeedparser) is installed, it is used instead of feedparser as
+# its lxml based parser is considerably faster on large feeds.
+#
+# The publishing date in the file names and ID3 tags is the UTC date, as fastfeedparser only reports dates
+# in UTC. Older versions used the date in the feed's own time zone, so episodes published late in the day
+# west of UTC (or early in the day east of it) are downloaded once more under their new name.
 #
 # It reads a config file called config.ini which should have the following format:
 # [podcast name]
 # path=<location of download path>
 # url=<link to RSS feed>
-# filename=<filename suffix in RSS feed items>
+# filename=<filename suffix in RSS feed items, defaults to stream.mp3 if left empty>
+# workers=<number of episodes downloaded in parallel, optional, defaults to 8>
+# preserve_id3=<keep existing ID3 frames besides title and date, optional, defaults to false>
+#
+# An optional [DEFAULT] section may set log=<log file, defaults to ./get_ml.log> and
+# loglevel=<logging level, defaults to DEBUG>.
 #
 # The section name consists of the podcast name which is used for the filename creation in 
 # get_feed. Depending on your preferences and file system, watch out for spaces in that name. 
+#
+# The ETag and Last-Modified headers of every section's feed are kept in feed_cache.json next to config.ini.
+# On the next run the feed is only fetched and parsed again if the server reports that it has changed.
+# Episodes whose download failed permanently (e.g. 404) are retried once the feed changes, those which
+# failed for a transient reason on the next run.
 
-import feedparser
+try:
+    import fastfeedparser as feedparser
+except ImportError:
+    import feedparser
 import pathlib
 import mutagen.easyid3
 import urllib
 import datetime
+import email.utils
 import configparser
+import concurrent.futures
+import json
 import os
-import shutil
-import subprocess
 import sys
 import logging
+import httpx
+
+# HTTP client shared by all feeds for fetching the RSS feeds as well as the episodes. Podcasts are
+# often served by the same hosting providers, so connections are kept alive and reused across feeds.
+# Feeds times workers may exceed the pool size, so waiting for a free connection is not limited and
+# excess downloads simply queue up. Redirects are followed like curl -L did before. Give every network
+# operation 5 minutes.
+_CLIENT = httpx.Client(follow_redirects=True, timeout=httpx.Timeout(5*60.0, pool=None),
+                       limits=httpx.Limits(max_connections=100, max_keepalive_connections=30,
+                                           keepalive_expiry=60))
+
+# Translation table to sanitize episode titles for file names in a single pass
+_FNAME_TABLE = str.maketrans({' ': '.', '/': '-'})
+
+# File keeping the URL, ETag and Last-Modified header per section for conditional fetches
+_CACHE_FILE = './feed_cache.json'
+
+# Number of episodes downloaded in parallel per feed unless configured otherwise
+_DEFAULT_WORKERS = 8
+
+# Chunk size used when streaming downloads to disk, bounds the memory used per download
+_CHUNK_SIZE = 1 << 16
 
 # Check if desination exists
 def check_presence(file_name):
    target = pathlib.Path(file_name)
    return target.exists()
 
-# Parse date based on PUBLISHED tag from the RSS feed 
+# Parse date based on PUBLISHED tag from the RSS feed. feedparser hands back the raw RFC 822 string
+# whereas fastfeedparser converts it to UTC and ISO 8601, so accept both. As the original offset is lost
+# with fastfeedparser, the date is always converted to UTC so that file names don't depend on the parser.
 def get_date(date_parm):
-    return datetime.datetime.strptime(date_parm, '%a, %d %b %Y %H:%M:%S %z')
-
-# Store meta information extracted from RSS entries. A default ID3 
-# is created if the downloaded audio file does not contain a corresponding
-# header structure already.
-def store_meta(target, entry, date):
-    dest = pathlib.Path(target)
-    if dest.exists():
+    try:
+        date = email.utils.parsedate_to_datetime(date_parm)
+    except (TypeError, ValueError):
+        date = datetime.datetime.fromisoformat(date_parm)
+    # Dates without offset are taken as UTC
+    if date.tzinfo is None:
+        return date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc)
+
+# Extract the link targets from an RSS entry which may point to the episode. The enclosures are the
+# downloadable media of an entry, so only if there are none all other links are considered. feedparser
+# calls the target href while fastfeedparser calls it url.
+def get_hrefs(entry):
+    hrefs = []
+    for j in entry.get('enclosures') or entry.get('links', []):
+        href = j.get('href') or j.get('url')
+        if href and href not in hrefs:
+            hrefs.append(href)
+    return hrefs
+
+# Store meta information extracted from RSS entries. Title and date are always overwritten, so by
+# default a fresh ID3 header is written without reading the existing one. Only if preserve is set, the
+# other frames of an existing header are kept and a default ID3 is created if the downloaded audio file
+# does not contain a corresponding header structure already.
+def store_meta(target, title, date, preserve):
+    if preserve:
         try:
-            logging.debug('Trying to eytract ID3 data from %s', str(dest))
+            logging.debug('Trying to eytract ID3 data from %s', target)
             audio = mutagen.easyid3.EasyID3(target)
-        except:
-            logging.warning('Could not extract ID3 from %s, creating default tags', str(dest))
+        except mutagen.MutagenError:
+            logging.warning('Could not extract ID3 from %s, creating default tags', target)
             audio = mutagen.easyid3.EasyID3()
     else:
-        logging.debug('File %s not present, creating ID3 default', str(dest))
         audio = mutagen.easyid3.EasyID3()
             
-    audio['title'] = entry['title']
+    audio['title'] = title
     audio['date'] = date
     try:
         audio.save(target, v2_version=3)
-    except MutagenError as e:
-        logging.error('Could not save audio metadata, exception: %s', str(e))
+    except mutagen.MutagenError as e:
+        logging.error('Could not save audio metadata, exception: %s', e)
 
-# Download a single file based on the URL parameter. At the moment, this requires a native
-# cURL binary as I couldn't get pycurl to run in a fast / performant way. Tips are welcome!
+# Download a single file based on the URL parameter. The response is streamed to disk in chunks
+# so that large episodes are never held in memory as a whole. The file is opened buffered as the buffered
+# writer retries short writes, while chunks larger than its buffer are passed through without copying.
+# Returns the exception which made the download fail or None if it went OK.
 def download_mp3(file_name, url):
-    # Use curl command for now, maybe substitued by pycurl later if performance problems are addressed
-    success = True
+    error = None
     logging.debug('Downloading to %s from %s', file_name, url)
-    # Give it 5 minutes to download
     try:
-        proc = subprocess.run(['curl', '-Lso', file_name, url], timeout=5*60)
-    except: 
-        logging.error('Could not download %s', url)
-        sucess = False
-    if proc.returncode != 0:
-        logging.error('curl returned exit code %d', proc.returncode)
-        success = False
-    return success
+        with open(file_name, 'wb') as f, _CLIENT.stream('GET', url) as r:
+            r.raise_for_status()
+            # writelines drives the chunk iterator from C instead of a Python level loop
+            f.writelines(r.iter_bytes(_CHUNK_SIZE))
+    except (httpx.HTTPError, httpx.InvalidURL, OSError) as e:
+        logging.error('Could not download %s, exception: %s', url, e)
+        error = e
+    return error
+
+# Tell whether a failed download may succeed when tried again later. Server errors, network and disk
+# trouble are transient, while client errors like a removed episode answering 404 are permanent, as are
+# malformed or unsupported URLs and redirect loops.
+def is_transient(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    if isinstance(error, httpx.UnsupportedProtocol):
+        return False
+    return isinstance(error, (httpx.TransportError, OSError))
+
+# Download a single episode and store its metadata. The episode is downloaded to a .part file which is
+# only renamed to its final name once it is complete and tagged, so an interrupted run never leaves
+# a file behind that looks like a finished episode. The .part file is removed if the download failed.
+# Returns True if the download failed in a way worth retrying on the next run.
+def get_episode(file_name, url, title, date_id3, preserve_id3):
+    tmp_name = file_name + '.part'
+    logging.debug('About to download feed %s to %s', tmp_name, url)
+    error = download_mp3(tmp_name, url)
+    # if download went OK, store metadata
+    if error is None:
+        store_meta(tmp_name, title, date_id3, preserve_id3)
+        logging.debug('Stored ID3 tags in %s', tmp_name)
+        os.rename(tmp_name, file_name)
+        return False
+    else:
+        # Remove file if download went south
+        logging.warning('Error ocurred during download, deleting %s', tmp_name)
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        return is_transient(error)
+
+# Load the feed validators per section from the cache file, starting afresh if it is missing or broken
+def load_cache():
+    try:
+        with open(_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.debug('No usable feed cache in %s: %s', _CACHE_FILE, e)
+        return {}
+
+def save_cache(cache):
+    try:
+        with open(_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        logging.error('Could not save feed cache to %s: %s', _CACHE_FILE, e)
+
+# Fetch the RSS feed with the shared client, conditionally if validators from a previous run are known.
+# Returns the response or None if the feed is unchanged or could not be fetched successfully.
+def fetch_rss(url, validators):
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('modified'):
+        headers['If-Modified-Since'] = validators['modified']
+    try:
+        r = _CLIENT.get(url, headers=headers)
+    except httpx.HTTPError as e:
+        logging.error('Could not fetch feed %s, exception: %s', url, e)
+        return None
+    if r.status_code == 304:
+        logging.debug('Feed %s not modified, skipping', url)
+        return None
+    # Error pages are usually HTML, so don't bother the parser with them
+    if r.status_code != 200:
+        logging.error('Fetching feed %s returned status %d', url, r.status_code)
+        return None
+    return r
 
 # Main working horse. Get RSS feed and iterate through the list of items, downloading these if a corresponding
-# file doesn't exist a the configured location (or has file size 0).
-def get_feed(path, url, show_name, suffix, date_func):
-    rss = feedparser.parse(url)
+# file doesn't exist a the configured location. Up to workers episodes are downloaded in parallel.
+# preserve_id3 tells store_meta whether to keep the existing ID3 frames of downloaded episodes.
+# The feed is requested conditionally based on the validators cached for the section, which are only
+# used as long as the section's URL is unchanged. They are updated after every successful fetch unless
+# a download failed for a transient reason, in which case they are dropped so that the next run fetches
+# the feed again and retries the download. Permanently failing episodes aren't retried until the feed changes.
+def get_feed(path, url, show_name, suffix, date_func, workers, cache, preserve_id3):
+    validators = cache.get(show_name, {})
+    if validators.get('url') != url:
+        validators = {}
+    r = fetch_rss(url, validators)
+    if r is None:
+        return
+    try:
+        # Hand over the fetched bytes, never the URL, so the parser doesn't download the feed a second time
+        rss = feedparser.parse(r.content)
+    except Exception as e:
+        # fastfeedparser raises instead of flagging the result as bozo
+        logging.error('Caught exception in RSS parse: %s', e)
+        return
     # Cehck if the parser caught an exception
     if 'bozo_exception' in rss:
-       loggging.error('Caught exception in RSS parse: %s', str(rss['bozo_exception']))
+        logging.error('Caught exception in RSS parse: %s', rss['bozo_exception'])
     else:
-        if rss.status == 200:
-            logging.debug('Status = 200, proceeding')
-            # Sanitize title for proper file name
-            for i in rss['items']:
-                if 'title' in i:
-                    name = i['title'].replace(' ', '.').replace('/', '-')
-                else:
-                    name = show_name
-                if 'published' in i:
-                    date = date_func(i['published'])
-                else:
-                    date = datetime.datetime.now()
-                # Transform according to ID3 v2 published format
-                date_id3 = date.strftime('%Y-%m-%d')
-                if 'links' in i:
-                    li = i['links']
-                    logging.debug('Links extracted: %s', str(li))
-                    for j in li:
-                        if 'href' in j:
-                            if j['href'].endswith(suffix):
-                                logging.debug('Processing HREF %s', j['href'])
-                                if name[-1] != '.':
-                                    name += '.'
-
-                                file_name = path + '/' + name + date_id3 + '.mp3'
-                                if not check_presence(file_name) or os.path.getsize(file_name) == 0:
-                                    logging.debug('About to download feed %s to %s', file_name, j['href'])
-                                    # if download went OK, store metadata
-                                    if download_mp3(file_name, j['href']):
-                                        store_meta(file_name, i, date_id3)
-                                        logging.debug('Stored ID3 tags in %s', file_name)
-                                    else:
-                                        # Remove file if download went south
-                                        logging.warning('Error ocurred during download, deleting %s', file_name)
-                                        os.unlink(file_name)
-                                else:
-                                    logging.debug('File %s already exists and has a file size greater 0', file_name)
-
-# Main function: check for curl presence and read config.
+        # Episodes to download keyed by file name so that no file is fetched twice at the same time
+        tasks = {}
+        # List the download directory once instead of probing it for every candidate episode
+        with os.scandir(path) as it:
+            existing = {e.name for e in it}
+        # Sanitize title for proper file name. fastfeedparser reports a missing title as an empty
+        # string, so fall back to the show name for both cases.
+        for i in rss.entries:
+            title = i.get('title')
+            if title:
+                name = title.translate(_FNAME_TABLE)
+            else:
+                title = name = show_name
+            if 'published' in i:
+                date = date_func(i.published)
+            else:
+                date = datetime.datetime.now()
+            # Transform according to ID3 v2 published format
+            date_id3 = date.strftime('%Y-%m-%d')
+            # The file name only depends on the entry, not on the link
+            if not name.endswith('.'):
+                name += '.'
+            base_name = f'{name}{date_id3}.mp3'
+            file_name = f'{path}/{base_name}'
+            li = get_hrefs(i)
+            logging.debug('Links extracted: %s', li)
+            for href in li:
+                if href.endswith(suffix):
+                    logging.debug('Processing HREF %s', href)
+                    if base_name not in existing:
+                        tasks.setdefault(file_name, (file_name, href, title, date_id3))
+                    # All links of an entry map to the same file name, so the first match is the episode
+                    break
+
+        # Downloads are I/O bound, so threads overlap them nicely
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(get_episode, *t, preserve_id3): t[0] for t in tasks.values()}
+        # Collect every result so that no exception of a later episode goes unnoticed. An episode which
+        # raised is retried on the next run.
+        retry = []
+        for future, file_name in futures.items():
+            if future.exception() is not None:
+                logging.error('Processing episode %s failed, exception: %s', file_name, future.exception())
+                retry.append(True)
+            else:
+                retry.append(future.result())
+        if any(retry):
+            logging.debug('Downloads of feed %s will be retried, dropping cached validators', url)
+            cache.pop(show_name, None)
+        else:
+            cache[show_name] = {'url': url, 'etag': r.headers.get('ETag'),
+                                'modified': r.headers.get('Last-Modified')}
+
+# Main function: read config and process the feeds.
 def main():
     if check_presence('./config.ini'):
         # Only continue if config file is present
         parser = configparser.ConfigParser()
-        # DEFAULT section contains log file path
+        # DEFAULT section contains log file path and log level
         # This is a hack to include the log file name setting in the ini file as DEFAULTSEC values appear in every section
         # iterated over, but as the key 'log' is never used in the extraction code below, it's probably OK :-)
-        parser['DEFAULT'] =  {'log': './get_ml.log'}
+        # The same mechanism provides the defaults for the number of parallel downloads per feed and
+        # whether existing ID3 frames are preserved.
+        parser['DEFAULT'] =  {'log': './get_ml.log', 'loglevel': 'DEBUG', 'workers': str(_DEFAULT_WORKERS), 'preserve_id3': 'false'}
         parser.read('config.ini')
-        logging.basicConfig(filename=parser['DEFAULT']['log'], filemode='a+', level=logging.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s',
+        # getLevelName maps known level names to their number and returns a string for anything else
+        level = logging.getLevelName(parser['DEFAULT']['loglevel'].upper())
+        logging.basicConfig(filename=parser['DEFAULT']['log'], filemode='a+',
+                            level=level if isinstance(level, int) else logging.DEBUG, format='%(asctime)s %(levelname)-8s %(message)s',
                             datefmt='%Y-%m-%d %H:%M:%S')
-        
-        # Check if curl is installed
-        if shutil.which('curl') == None:
-            logging.error('No curl in $PATH, aborting')
-            return -1
+        if not isinstance(level, int):
+            logging.warning('Unknown log level %s, using DEBUG', parser['DEFAULT']['loglevel'])
+        # Keep the per request trace records of the HTTP client out of the log
+        logging.getLogger('httpcore').setLevel(logging.WARNING)
+        logging.getLogger('httpx').setLevel(logging.WARNING)
 
-        for i in parser.sections():
-            sec = parser[i]
+        # Feeds are processed concurrently as fetching them is dominated by network latency
+        cache = load_cache()
+        feeds = {}
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for i in parser.sections():
+                sec = parser[i]
 
-            if len(sec['filename']) == 0:
-                file_name = 'stream.mp3'
-            else:
-                file_name = sec['filename']
+                if len(sec.get('filename', '')) == 0:
+                    file_name = 'stream.mp3'
+                else:
+                    file_name = sec['filename']
                 path = sec['path']
-                
+
+                try:
+                    workers = sec.getint('workers')
+                except ValueError:
+                    workers = 0
+                if workers < 1:
+                    logging.warning('Invalid workers setting %s for %s, using %d', sec['workers'], i, _DEFAULT_WORKERS)
+                    workers = _DEFAULT_WORKERS
+                try:
+                    preserve_id3 = sec.getboolean('preserve_id3')
+                except ValueError:
+                    logging.warning('Invalid preserve_id3 setting %s for %s, using false', sec['preserve_id3'], i)
+                    preserve_id3 = False
+
                 if os.path.isdir(path) and os.access(path, os.W_OK):
                     logging.debug('Getting feed %s for path %s and filename %s', sec['url'], path, file_name)
-                    get_feed(path, sec['url'], i, file_name, get_date)
+                    feeds[executor.submit(get_feed, path, sec['url'], i, file_name, get_date,
+                                            workers, cache, preserve_id3)] = i
                 else:
                     logging.warning('%s is not a path or not writable, skipping', path)
+
+            for future in concurrent.futures.as_completed(feeds):
+                if future.exception() is not None:
+                    logging.error('Processing feed %s failed, exception: %s', feeds[future], future.exception())
+        save_cache(cache)
     else:
         logging.error('No config.ini in current directory, exiting')
 